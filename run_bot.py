@@ -1,12 +1,24 @@
 import yfinance as yf
 import pandas as pd
-import pandas_ta as ta
+import numpy as np
+import pyarrow
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
 import json
+import csv
 import os
 import io
+import shlex
 import subprocess
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # --- LOAD SECRETS ---
 TOKEN = os.environ["TELEGRAM_TOKEN"]
@@ -15,130 +27,265 @@ CHAT_ID = os.environ["TELEGRAM_CHAT_ID"]
 # --- CONFIGURATION ---
 MAX_POSITIONS = 2
 PORTFOLIO_FILE = 'portfolio.json'
+CACHE_DIR = 'cache'
+HISTORY_YEARS = 2
+NIFTY_TICKER = "^NSEI"
+# Explicit yf.download options: parallel per-ticker fetches, no post-processing this bot doesn't use
+YF_OPTIONS = dict(group_by='ticker', progress=False, threads=True, auto_adjust=False,
+                  actions=False, prepost=False, repair=False)
+NIFTY100_CACHE_FILE = os.path.join(CACHE_DIR, 'nifty100_cache.json')
+
+# Shared HTTP session: reuses TCP+TLS connections across calls
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+SESSION.headers['User-Agent'] = 'Mozilla/5.0'
 
 def send_telegram(message):
     try:
         url = f"https://api.telegram.org/bot{TOKEN}/sendMessage"
         payload = {"chat_id": CHAT_ID, "text": message, "parse_mode": "Markdown"}
-        requests.post(url, json=payload, timeout=10)
+        SESSION.post(url, json=payload, timeout=10)
     except Exception as e:
         print(f"Telegram Error: {e}")
 
 def git_commit_push(message):
-    subprocess.run(["git", "config", "--global", "user.email", "actions@github.com"])
-    subprocess.run(["git", "config", "--global", "user.name", "Trading Bot"])
-    subprocess.run(["git", "add", PORTFOLIO_FILE])
-    subprocess.run(["git", "commit", "-m", message])
-    subprocess.run(["git", "push"])
+    # Identity passed inline (no ~/.gitconfig rewrite); a clean tree just skips the push
+    subprocess.run(
+        f"git add {PORTFOLIO_FILE}"
+        f" && git -c user.email=actions@github.com -c user.name='Trading Bot' commit -m {shlex.quote(message)}"
+        " && git push",
+        shell=True, check=False)
 
 def load_portfolio():
     if not os.path.exists(PORTFOLIO_FILE):
         return {"cash": 25000, "holdings": [], "last_update_id": 0}
-    with open(PORTFOLIO_FILE, 'r') as f:
-        return json.load(f)
+    if orjson is None:
+        with open(PORTFOLIO_FILE, 'r') as f:
+            return json.load(f)
+    with open(PORTFOLIO_FILE, 'rb') as f:
+        return orjson.loads(f.read())
 
 def save_portfolio(data):
-    with open(PORTFOLIO_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+    # Both writers emit the same 2-space layout, keeping the committed diffs minimal
+    if orjson is None:
+        with open(PORTFOLIO_FILE, 'w') as f:
+            json.dump(data, f, indent=2)
+        return
+    with open(PORTFOLIO_FILE, 'wb') as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+def _do_buy(holdings_by_sym, parts, acks):
+    if len(parts) < 3: return False
+    symbol = parts[1]
+    shares = int(parts[2])
+    holdings_by_sym[symbol] = {"symbol": symbol, "shares": shares}
+    acks.append(f"✅ *System Updated:* Added {shares} shares of {symbol}.")
+    return True
+
+def _do_sell(holdings_by_sym, parts, acks):
+    if len(parts) < 2: return False
+    symbol = parts[1]
+    if not holdings_by_sym.pop(symbol, None): return False
+    acks.append(f"✅ *System Updated:* Removed {symbol} from holdings.")
+    return True
+
+def _do_reset(holdings_by_sym, parts, acks):
+    if len(parts) != 1: return False
+    holdings_by_sym.clear()
+    acks.append(f"⚠️ *System Reset:* All holdings cleared.")
+    return True
+
+# Telegram command -> handler(holdings_by_sym, parts, acks), returns True if holdings changed
+HANDLERS = {'/BUY': _do_buy, '/SELL': _do_sell, '/RESET': _do_reset}
 
 def check_telegram_commands(portfolio):
     last_id = portfolio.get('last_update_id', 0)
     url = f"https://api.telegram.org/bot{TOKEN}/getUpdates?offset={last_id + 1}"
     try:
-        response = requests.get(url, timeout=10).json()
-    except: return portfolio, False
+        response = SESSION.get(url, timeout=10).json()
+    except (requests.RequestException, ValueError): return portfolio, False
 
     changes_made = False
+    acks = []
+    holdings_by_sym = {h['symbol']: h for h in portfolio['holdings']}
     for item in response.get('result', []):
-        update_id = item['update_id']
-        message = item.get('message', {}).get('text', '').strip().upper()
-        
-        if message.startswith('/BUY'):
-            parts = message.split()
-            if len(parts) >= 3:
-                symbol = parts[1]
-                shares = int(parts[2])
-                portfolio['holdings'].append({"symbol": symbol, "shares": shares})
-                changes_made = True
-                send_telegram(f"✅ *System Updated:* Added {shares} shares of {symbol}.")
-
-        elif message.startswith('/SELL'):
-            parts = message.split()
-            if len(parts) >= 2:
-                symbol = parts[1]
-                new_holdings = [h for h in portfolio['holdings'] if h['symbol'] != symbol]
-                if len(new_holdings) < len(portfolio['holdings']):
-                    portfolio['holdings'] = new_holdings
-                    changes_made = True
-                    send_telegram(f"✅ *System Updated:* Removed {symbol} from holdings.")
-        
-        elif message == '/RESET':
-            portfolio['holdings'] = []
-            changes_made = True
-            send_telegram(f"⚠️ *System Reset:* All holdings cleared.")
-
-        portfolio['last_update_id'] = update_id
+        parts = item.get('message', {}).get('text', '').upper().split()
+        # Group chats address commands to the bot as /BUY@BOTNAME
+        handler = HANDLERS.get(parts[0].split('@', 1)[0]) if parts else None
+        if handler: changes_made |= handler(holdings_by_sym, parts, acks)
+        portfolio['last_update_id'] = item['update_id']
 
+    # One confirmation message per batch of updates
+    if acks: send_telegram("\n".join(acks))
+    portfolio['holdings'] = list(holdings_by_sym.values())
     return portfolio, changes_made
 
 def get_nifty100_live():
-    try:
-        url = "https://nsearchives.nseindia.com/content/indices/ind_nifty100list.csv"
-        headers = {"User-Agent": "Mozilla/5.0"}
-        response = requests.get(url, headers=headers, timeout=10)
-        df = pd.read_csv(io.BytesIO(response.content))
-        # Filter out "DUMMY" or other bad tickers
-        tickers = [f"{x}.NS" for x in df['Symbol'].tolist() if "DUMMY" not in str(x).upper()]
-        return tickers
-    except:
-        return ["RELIANCE.NS", "HDFCBANK.NS", "INFY.NS", "TCS.NS", "ITC.NS"]
+    # Constituents change quarterly at most: reuse today's list if already fetched
+    if os.path.exists(NIFTY100_CACHE_FILE) and \
+            datetime.fromtimestamp(os.path.getmtime(NIFTY100_CACHE_FILE)).date() == date.today():
+        try:
+            with open(NIFTY100_CACHE_FILE, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"NIFTY 100 Cache Error: {e}")
+
+    url = "https://nsearchives.nseindia.com/content/indices/ind_nifty100list.csv"
+    for attempt in range(2):
+        try:
+            with SESSION.get(url, timeout=10, stream=True) as response:
+                response.raise_for_status()
+                # Parse the CSV as it streams in; only the Symbol column is needed
+                response.raw.decode_content = True
+                rows = csv.DictReader(io.TextIOWrapper(response.raw, encoding='utf-8-sig'))
+                # Filter out "DUMMY" or other bad tickers
+                symbols = ((row.get('Symbol') or '').strip() for row in rows)
+                tickers = [f"{x}.NS" for x in symbols if x and "DUMMY" not in x.upper()]
+            if tickers:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                with open(NIFTY100_CACHE_FILE, 'w') as f:
+                    json.dump(tickers, f)
+                return tickers
+            print(f"NIFTY 100 Fetch Error (attempt {attempt + 1}): no symbols in response")
+        # Reading response.raw directly surfaces urllib3's own errors (resets, timeouts, bad gzip)
+        except (requests.RequestException, urllib3.exceptions.HTTPError, csv.Error, UnicodeDecodeError) as e:
+            print(f"NIFTY 100 Fetch Error (attempt {attempt + 1}): {e}")
+        if attempt == 0: time.sleep(0.5)
+    return ["RELIANCE.NS", "HDFCBANK.NS", "INFY.NS", "TCS.NS", "ITC.NS"]
+
+def _split_by_ticker(raw, tickers):
+    # yf.download only nests columns per ticker for multi-ticker (or newer yfinance) calls
+    if raw is None or raw.empty: return {}
+    if not isinstance(raw.columns, pd.MultiIndex): return {tickers[0]: raw}
+    present = raw.columns.get_level_values(0)
+    return {t: raw[t] for t in tickers if t in present}
+
+def _overlap_bar(df):
+    return df.index[max(len(df) - 2, 0)]
+
+def download_prices(tickers):
+    # Incremental OHLC cache: one parquet per ticker, only the missing tail is fetched
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cached = {}
+    for t in tickers:
+        path = os.path.join(CACHE_DIR, f"{t}.parquet")
+        if os.path.exists(path):
+            # An unreadable cache file just means a full refetch of that ticker
+            try:
+                cached[t] = pd.read_parquet(path, engine='pyarrow')
+            except (OSError, ValueError, pyarrow.ArrowException) as e:
+                print(f"Price Cache Error ({t}): {e}")
+
+    # Tail fetch overlaps the cache by one completed bar (the last one may be intraday).
+    # Tickers are grouped by their own start, so one that stopped trading doesn't drag the rest back
+    by_start = {}
+    for t, df in cached.items():
+        by_start.setdefault(_overlap_bar(df), []).append(t)
+    fresh = {}
+    for start, stale in by_start.items():
+        raw = yf.download(stale, start=start.strftime('%Y-%m-%d'), **YF_OPTIONS)
+        fresh.update(_split_by_ticker(raw, stale))
+
+    # Splits/bonuses make Yahoo restate history: if the overlap bar moved, refetch in full
+    for t in list(cached):
+        old, new = cached[t], fresh.get(t)
+        anchor = _overlap_bar(old)
+        if new is None or anchor not in new.index: continue
+        before, after = old.at[anchor, 'Close'], new.at[anchor, 'Close']
+        if pd.notna(before) and pd.notna(after) and not np.isclose(before, after, rtol=1e-3):
+            del cached[t], fresh[t]
+
+    missing = [t for t in tickers if t not in cached]
+    if missing:
+        raw = yf.download(missing, period=f"{HISTORY_YEARS}y", **YF_OPTIONS)
+        fresh.update(_split_by_ticker(raw, missing))
+
+    frames = {}
+    for t in tickers:
+        new = fresh.get(t)
+        if new is not None: new = new.dropna(how='all')
+        old = cached.get(t)
+        if old is None and (new is None or new.empty): continue
+        if old is None: df = new
+        elif new is None or new.empty: df = old
+        else:
+            df = pd.concat([old, new])
+            df = df[~df.index.duplicated(keep='last')].sort_index()
+        df = df[df.index >= df.index.max() - pd.DateOffset(years=HISTORY_YEARS)]
+        if new is not None and not new.empty:
+            df.to_parquet(os.path.join(CACHE_DIR, f"{t}.parquet"), engine='pyarrow')
+        frames[t] = df
+
+    if not frames: return pd.DataFrame()
+    return pd.concat(frames, axis=1)
 
 def main():
-    # PHASE 1: SYNC
+    # PHASE 1: SYNC (independent network I/O runs concurrently)
     portfolio = load_portfolio()
-    portfolio, updated = check_telegram_commands(portfolio)
-    if updated:
-        save_portfolio(portfolio)
-        try: git_commit_push("Auto-update")
-        except: pass
-
-    # PHASE 2: ANALYSIS
-    holdings = portfolio['holdings']
-    my_symbols = [x['symbol'] for x in holdings]
-    tickers = get_nifty100_live()
-    all_tickers = list(set(tickers + [f"{s}.NS" for s in my_symbols]))
-    
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        tickers_job = pool.submit(get_nifty100_live)
+        sync_job = pool.submit(check_telegram_commands, portfolio)
+
+        portfolio, updated = sync_job.result()
+        if updated:
+            save_portfolio(portfolio)
+            try: git_commit_push("Auto-update")
+            except OSError: pass
+
+        # PHASE 2: ANALYSIS
+        holdings = portfolio['holdings']
+        my_symbols = [x['symbol'] for x in holdings]
+        tickers = tickers_job.result()
+
     # Identify Schedule
     today = datetime.now()
     is_rebalance_period = today.day <= 7
-    
+    # Ranks are only used for the monthly rebalance or to fill free slots;
+    # otherwise only the holdings and NIFTY itself need prices
+    needs_ranking = is_rebalance_period or len(holdings) < MAX_POSITIONS
+    universe = tickers if needs_ranking else []
+
+    # NIFTY rides along in the bulk download instead of a second yfinance call
+    all_tickers = list(set(universe + [f"{s}.NS" for s in my_symbols] + [NIFTY_TICKER]))
+
     # Download Data (Robust)
-    # Using 'threads=False' is slower but more stable if you are getting 404 errors
-    data = yf.download(all_tickers, period="2y", group_by='ticker', progress=False, threads=True)
-    nifty = yf.download("^NSEI", period="2y", progress=False)
-    
-    if isinstance(nifty.columns, pd.MultiIndex): nifty.columns = nifty.columns.get_level_values(0)
-    nifty['SMA_200'] = ta.sma(nifty['Close'], length=200)
-    market_safe = nifty['Close'].iloc[-1] > nifty['SMA_200'].iloc[-1]
-    
-    # Calculate Ranks
-    rank_scores = {}
-    for t in tickers:
-        try:
-            df = data[t].copy()
-            if isinstance(df.columns, pd.MultiIndex): df.columns = df.columns.get_level_values(0)
-            
-            # --- SAFETY CHECKS ---
-            df.dropna(subset=['Close'], inplace=True)
-            if len(df) < 250: continue 
-            
-            # FIX: Added fill_method=None to silence warning
-            score = df['Close'].pct_change(periods=21, fill_method=None).iloc[-1] * 100
-            rank_scores[t.replace('.NS','')] = score
-        except: continue
+    data = download_prices(all_tickers)
+
+    nifty_close = data[(NIFTY_TICKER, 'Close')].dropna()
+    market_safe = nifty_close.iloc[-1] > nifty_close.rolling(200, min_periods=200).mean().iloc[-1]
     
-    sorted_ranks = sorted(rank_scores.items(), key=lambda x: x[1], reverse=True)
-    top_15 = [x[0] for x in sorted_ranks[:15]]
+    # RED market exits everything: skip per-ticker indicators and ranking
+    sorted_ranks, top_15 = [], []
+    if market_safe:
+        # Indicators for every ticker at once on the wide (dates x tickers) close matrix.
+        # NIFTY is left out so its dates don't add NaN rows
+        closes = data.drop(columns=NIFTY_TICKER, level=0).xs('Close', level=1, axis=1).dropna(how='all')
+        history = closes.count()
+        # Stable-sort each column's NaNs to the top, so the bottom rows are every ticker's own
+        # latest valid bars and a missing bar doesn't blank its last close or 200-bar average
+        v = closes.to_numpy()
+        v = np.take_along_axis(v, np.argsort(~np.isnan(v), axis=0, kind='stable'), axis=0)
+        last = pd.Series(v[-1], index=closes.columns)
+        # A suspended/delisted ticker keeps its old cached bars: treat it as stale, not as current
+        up_to_date = closes.loc[nifty_close.index[-1]:].notna().any()
+        sma200 = pd.Series(np.where(history.values >= 200, v[-200:].mean(axis=0), np.nan), index=closes.columns)
+
+        if needs_ranking:
+            # Calculate Ranks: 21-day momentum of NIFTY 100 names
+            # --- SAFETY CHECKS --- (at least 250 bars of history, no missing score)
+            ranked = closes.columns.isin(tickers) & (history.values >= 250)
+            # 21 bars back along each ticker's own valid bars (compacted matrix), not the shared date index
+            scores = (v[-1, ranked] / v[-22, ranked] - 1.0) * 100
+            valid = ~np.isnan(scores)
+            scores = scores[valid]
+            symbols = [c.replace('.NS','') for c in closes.columns[ranked][valid]]
+
+            # Partial sort: select the top 15 in O(N), then order just those
+            k = min(15, len(scores))
+            idx = np.argpartition(-scores, k - 1)[:k] if k else np.array([], dtype=int)
+            idx = idx[np.argsort(-scores[idx])]
+            sorted_ranks = [(symbols[i], scores[i]) for i in idx]
+            top_15 = [x[0] for x in sorted_ranks]
 
     # BUILD REPORT
     report = []
@@ -151,22 +298,24 @@ def main():
         report.append("*🔍 YOUR POSITIONS:*")
         for h in holdings:
             sym = h['symbol']
+            # THE 3 RULES
+            if not market_safe:
+                report.append(f"🚨 SELL {sym} (Market Crash)")
+                continue
             try:
-                df = data[f"{sym}.NS"].copy()
-                if isinstance(df.columns, pd.MultiIndex): df.columns = df.columns.get_level_values(0)
-                current = df['Close'].iloc[-1]
-                sma = ta.sma(df['Close'], length=200).iloc[-1]
+                if not up_to_date[f"{sym}.NS"]:
+                    report.append(f"⚠️ {sym} (Data Error)")
+                    continue
+                current = last[f"{sym}.NS"]
+                sma = sma200[f"{sym}.NS"]
                 
-                # THE 3 RULES
-                if not market_safe:
-                    report.append(f"🚨 SELL {sym} (Market Crash)")
-                elif current < sma:
+                if current < sma:
                     report.append(f"❌ SELL {sym} (Trend Broken)")
                 elif is_rebalance_period and sym not in top_15:
                     report.append(f"❌ SELL {sym} (Rank Drop - Out of Top 15)")
                 else:
                     report.append(f"✅ HOLD {sym} (₹{int(current)})")
-            except:
+            except (KeyError, IndexError, ValueError):
                 report.append(f"⚠️ {sym} (Data Error)")
     else:
         report.append("ℹ️ Portfolio Empty.")
@@ -180,12 +329,10 @@ def main():
             if stock not in my_symbols:
                 # Double check 200 DMA for buy candidate
                 try:
-                    df = data[f"{stock}.NS"].copy()
-                    if isinstance(df.columns, pd.MultiIndex): df.columns = df.columns.get_level_values(0)
-                    if df['Close'].iloc[-1] > ta.sma(df['Close'], length=200).iloc[-1]:
+                    if up_to_date[f"{stock}.NS"] and last[f"{stock}.NS"] > sma200[f"{stock}.NS"]:
                         report.append(f"👉 {stock} (Score: {score:.1f}%)")
                         count += 1
-                except: continue
+                except KeyError: continue
 
     final_msg = "\n".join(report)
     print(final_msg)